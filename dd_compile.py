@@ -0,0 +1,1317 @@
+"""Compile a Due Diligence master document from the files in ``docs/``.
+
+Reads every supported document (PDF, PPTX, XLSX) under the docs directory,
+asks the OpenAI Responses API to extract facts for each section defined in
+``master-document-template.json``, merges the validated extractions into an
+output JSON document with evidence quotes, and finally renders a DOCX for
+human review.
+
+Only information that can be backed by a verbatim quote from a source
+document is accepted — the model is instructed not to invent anything, and
+every evidence quote is re-checked against the source text before merging.
+"""
+
+from __future__ import annotations
+
+import argparse
+import copy
+import functools
+import hashlib
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import ahocorasick
+except ImportError:  # pragma: no cover - optional speedup
+    ahocorasick = None
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - optional speedup
+    tiktoken = None
+
+try:
+    from python_calamine import CalamineWorkbook
+except ImportError:  # pragma: no cover - optional speedup
+    CalamineWorkbook = None
+
+DEFAULT_MODEL = "gpt-5.2"
+DEFAULT_MAX_CHUNK_CHARS = 12000
+DEFAULT_CONCURRENCY = 8
+
+# Bump whenever SYSTEM_PROMPT, the schema, or the user-message layout
+# changes in a way the cache key's literal text would not capture, so
+# stale cached responses are invalidated automatically.
+PROMPT_VERSION = "v1"
+
+SYSTEM_PROMPT = (
+    "You are a due diligence analyst. You extract facts from source documents "
+    "into a structured report. You only report information that is explicitly "
+    "stated in the source text. You never invent, infer or embellish. For every "
+    "extracted value you must include at least one verbatim evidence quote "
+    "copied exactly from the source text. If the source contains nothing "
+    "relevant for a field, omit that field entirely. Respond with a JSON object "
+    'of the form {"extractions": [{"pointer": ..., "value": ..., '
+    '"evidence": [{"source_index": ..., "quote": ...}]}]} where source_index '
+    "is the index of the source the quote was copied from, and nothing else."
+)
+
+# Strict response schema for structured outputs: the API decoder itself
+# guarantees well-formed extraction envelopes, so malformed JSON and
+# markdown-fenced replies disappear instead of being repaired client-side.
+EXTRACTIONS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "extractions": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "pointer": {"type": "string"},
+                    "value": {"type": "string"},
+                    "evidence": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "source_index": {"type": "integer"},
+                                "quote": {"type": "string"},
+                            },
+                            "required": ["source_index", "quote"],
+                            "additionalProperties": False,
+                        },
+                    },
+                },
+                "required": ["pointer", "value", "evidence"],
+                "additionalProperties": False,
+            },
+        }
+    },
+    "required": ["extractions"],
+    "additionalProperties": False,
+}
+
+# Combined character budget for one extraction request. Several short
+# chunks are packed into a single call so the fixed per-request cost
+# (RTT, system prompt, field catalog) is amortized across them.
+MAX_COMBINED_CHARS = 16000
+
+# Rough English-prose ratio used to convert the character budget into a
+# token budget when tiktoken is available.
+APPROX_CHARS_PER_TOKEN = 4
+
+# Documents whose entire extracted text is shorter than this are skipped
+# before any API call; they cannot contribute a meaningful extraction.
+MIN_DOC_CHARS = 200
+
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder(model: str):
+    """Return the tiktoken encoder for ``model``, or None without tiktoken."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+# Compiled once at import; these run on every chunk of every page/slide,
+# so re-compiling them per call would dominate the normalization cost.
+_RE_NEWLINES = re.compile(r"\n{3,}")
+_RE_SPACES = re.compile(r"[ ]{2,}")
+_RE_ANY_WS = re.compile(r"\s+")
+_RE_FENCE_OPEN = re.compile(r"^```(?:json)?\s*")
+_RE_FENCE_CLOSE = re.compile(r"\s*```$")
+
+# C-level single-pass replacement of NBSP/tab/CR, instead of chained
+# str.replace and a tab regex.
+_WS_TRANSLATE = str.maketrans({" ": " ", "\t": " ", "\r": "\n"})
+
+
+@dataclass
+class TextChunk:
+    """One extractable piece of source text with its provenance."""
+
+    source_file: str
+    location: str
+    text: str
+
+
+@dataclass(slots=True, frozen=True)
+class Evidence:
+    """One verified evidence quote backing an extracted value.
+
+    Slots keep the per-instance footprint small; a large corpus can
+    produce thousands of these.
+    """
+
+    source_file: str
+    source_location: str
+    quote: str
+
+
+# ---------------------------------------------------------------------------
+# Text extraction
+# ---------------------------------------------------------------------------
+
+
+def _normalize_whitespace(text: str) -> str:
+    """Collapse exotic whitespace so chunking and quote matching are stable."""
+    # Common case first: already-clean ASCII text needs no regex pass at
+    # all, and these substring checks are C-level scans.
+    if (
+        text.isascii()
+        and "\t" not in text
+        and "\r" not in text
+        and "\n\n\n" not in text
+        and "  " not in text
+    ):
+        return text.strip()
+    s = text.replace("\r\n", "\n").translate(_WS_TRANSLATE)
+    s = _RE_NEWLINES.sub("\n\n", s)
+    s = _RE_SPACES.sub(" ", s)
+    return s.strip()
+
+
+def _chunk_text(text: str, max_chars: int, overlap: int = 400) -> List[str]:
+    """Split normalized text into chunks of at most ``max_chars`` characters.
+
+    Prefers paragraph boundaries, then line boundaries, so that evidence
+    quotes are unlikely to straddle a chunk border. As a second line of
+    defence, each chunk after the first repeats up to ``overlap``
+    characters from the end of its predecessor, so a fact split across a
+    forced mid-paragraph cut is still seen whole in one chunk.
+    """
+    if not text:
+        return []
+    # Fast path: short text that is already normalized needs neither the
+    # regex passes nor the split loop. Plain substring checks are C-level
+    # scans, far cheaper than running the normalizer to find out.
+    if (
+        len(text) <= max_chars
+        and "\xa0" not in text
+        and "\t" not in text
+        and "\r" not in text
+        and "\n\n\n" not in text
+        and "  " not in text
+    ):
+        stripped = text.strip()
+        return [stripped] if stripped else []
+    normalized = _normalize_whitespace(text)
+    if not normalized:
+        return []
+    chunks: List[str] = []
+    rest = normalized
+    while len(rest) > max_chars:
+        cut = rest.rfind("\n\n", 0, max_chars)
+        if cut <= 0:
+            cut = rest.rfind("\n", 0, max_chars)
+        forced = cut <= 0
+        if forced:
+            cut = max_chars
+        chunks.append(rest[:cut].strip())
+        if forced and overlap > 0 and cut > overlap:
+            # The cut landed mid-paragraph, so carry the trailing context
+            # into the next chunk. Concatenate before stripping: the cut
+            # may land on whitespace, and stripping first would glue the
+            # overlap onto the remainder as a token that never existed in
+            # the source. Keeping the overlap smaller than the cut
+            # guarantees the loop still shrinks ``rest``.
+            rest = (rest[cut - overlap : cut] + rest[cut:]).strip()
+        else:
+            rest = rest[cut:].strip()
+    if rest:
+        chunks.append(rest)
+    return chunks
+
+
+def _extract_pdf_pdftotext(path: Path, max_chars: int) -> List[TextChunk]:
+    """Extract PDF text by shelling out to Poppler's ``pdftotext``.
+
+    One process invocation emits all pages at once, separated by form
+    feeds — considerably faster than Python-level per-page parsing on
+    bulk extraction.
+    """
+    result = subprocess.run(
+        # Reading-order output (no -layout): layout reconstruction costs
+        # extra time per page only to produce column padding that the
+        # whitespace normalizer collapses anyway — the model reads prose,
+        # not page geometry.
+        ["pdftotext", "-enc", "UTF-8", str(path), "-"],
+        capture_output=True,
+        check=True,
+    )
+    chunks: List[TextChunk] = []
+    for i, page_text in enumerate(result.stdout.decode("utf-8").split("\f"), start=1):
+        if not page_text.strip():
+            continue
+        for part in _chunk_text(page_text, max_chars):
+            chunks.append(TextChunk(path.name, f"page {i}", part))
+    return chunks
+
+
+def _extract_pdf(path: Path, max_chars: int) -> List[TextChunk]:
+    if shutil.which("pdftotext"):
+        try:
+            return _extract_pdf_pdftotext(path, max_chars)
+        except (subprocess.CalledProcessError, UnicodeDecodeError):
+            pass  # fall back to PyMuPDF below
+
+    import pymupdf
+
+    chunks: List[TextChunk] = []
+    doc = pymupdf.open(str(path))
+    for i, page in enumerate(doc, start=1):
+        text = page.get_text("text")
+        if not text:
+            # Graphics-only page; skip the chunking pipeline entirely.
+            continue
+        for part in _chunk_text(text, max_chars):
+            chunks.append(TextChunk(path.name, f"page {i}", part))
+    doc.close()
+    return chunks
+
+
+def _extract_pptx(path: Path, max_chars: int) -> List[TextChunk]:
+    from pptx import Presentation
+
+    chunks: List[TextChunk] = []
+    prs = Presentation(str(path))
+    for i, slide in enumerate(prs.slides, start=1):
+        texts = []
+        for shape in slide.shapes:
+            if shape.has_text_frame and shape.text_frame.text.strip():
+                texts.append(shape.text_frame.text)
+        if not texts:
+            continue
+        combined = "\n".join(texts)
+        for part in _chunk_text(combined, max_chars):
+            chunks.append(TextChunk(path.name, f"slide {i}", part))
+    return chunks
+
+
+def _extract_xlsx_calamine(path: Path, max_chars: int) -> List[TextChunk]:
+    """XLSX extraction via python-calamine's Rust reader.
+
+    Several times faster than openpyxl on data-only reads; produces the
+    same tab-joined row text as the openpyxl path.
+    """
+    chunks: List[TextChunk] = []
+    wb = CalamineWorkbook.from_path(str(path))
+    for sheet_name in wb.sheet_names:
+        rows = wb.get_sheet_by_name(sheet_name).to_python(skip_empty_area=True)
+        lines = []
+        for row in rows:
+            if not any(v is not None and str(v).strip() for v in row):
+                continue
+            lines.append("\t".join("" if v is None else str(v) for v in row))
+        combined = "\n".join(lines)
+        for part in _chunk_text(combined, max_chars):
+            chunks.append(TextChunk(path.name, f"sheet {sheet_name}", part))
+    return chunks
+
+
+def _extract_xlsx(path: Path, max_chars: int) -> List[TextChunk]:
+    if CalamineWorkbook is not None:
+        return _extract_xlsx_calamine(path, max_chars)
+
+    from openpyxl import load_workbook
+
+    chunks: List[TextChunk] = []
+    # read_only streams rows instead of building the full in-memory DOM
+    # (cell styles, formula cache, ...) that we would never look at.
+    wb = load_workbook(
+        filename=str(path), data_only=True, read_only=True, keep_links=False
+    )
+    try:
+        for ws in wb.worksheets:
+            lines = []
+            for row in ws.iter_rows(values_only=True):
+                # Sparse sheets are mostly empty rows; skip them before
+                # allocating any per-cell strings.
+                if not any(v is not None and str(v).strip() for v in row):
+                    continue
+                lines.append("\t".join("" if v is None else str(v) for v in row))
+            combined = "\n".join(lines)
+            for part in _chunk_text(combined, max_chars):
+                chunks.append(TextChunk(path.name, f"sheet {ws.title}", part))
+    finally:
+        # Required in read-only mode: close() releases the underlying
+        # ZipFile handle even when a sheet fails to parse.
+        wb.close()
+    return chunks
+
+
+_EXTRACTORS = {
+    ".pdf": _extract_pdf,
+    ".pptx": _extract_pptx,
+    ".xlsx": _extract_xlsx,
+}
+
+
+def _extract_one_file(path: Path, max_chars: int) -> List[TextChunk]:
+    """Extract all chunks from one file; top-level so it pickles."""
+    extractor = _EXTRACTORS.get(path.suffix.lower())
+    if extractor is None:
+        return []
+    return extractor(path, max_chars)
+
+
+def _iter_doc_paths(root: Path):
+    """Yield supported document paths under ``root``, recursively.
+
+    scandir gives is_file()/is_dir() from the directory entry itself,
+    avoiding a stat per path, and hidden/unsupported entries drop out
+    before any worker is spawned for them.
+    """
+    for entry in os.scandir(root):
+        if entry.name.startswith("."):
+            continue
+        if entry.is_dir():
+            yield from _iter_doc_paths(Path(entry.path))
+        elif (
+            entry.is_file()
+            and os.path.splitext(entry.name)[1].lower() in _EXTRACTORS
+        ):
+            yield Path(entry.path)
+
+
+def extract_text_chunks_from_docs(
+    docs_dir: Path,
+    max_chars: int,
+    cache_dir: Optional[Path] = None,
+    max_workers: Optional[int] = None,
+) -> List[TextChunk]:
+    """Extract text chunks from every supported file under ``docs_dir``.
+
+    Files are parsed in parallel across a process pool — PDF/PPTX/XLSX
+    parsing is CPU-bound Python work that a thread pool could not spread
+    over cores. When ``cache_dir`` is given, extraction results are cached
+    on disk keyed by the file content hash, so unchanged documents are
+    never re-parsed on later runs.
+    """
+    manifest: Dict[str, dict] = {}
+    manifest_path = None
+    if cache_dir is not None:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        manifest_path = cache_dir / "manifest.json"
+        if manifest_path.exists():
+            manifest = _read_json(manifest_path)
+    paths = sorted(_iter_doc_paths(docs_dir))
+
+    results: Dict[Path, List[TextChunk]] = {}
+    cache_paths: Dict[Path, Path] = {}
+    to_parse: List[Path] = []
+    for path in paths:
+        if cache_dir is not None:
+            # Manifest fast path: an unchanged (mtime, size) pair means the
+            # recorded digest is still valid, skipping the full-file hash.
+            st = path.stat()
+            rel = str(path.relative_to(docs_dir))
+            entry = manifest.get(rel)
+            if entry and entry["mtime"] == st.st_mtime and entry["size"] == st.st_size:
+                digest = entry["digest"]
+            else:
+                digest = hashlib.sha1(path.read_bytes()).hexdigest()
+                manifest[rel] = {
+                    "mtime": st.st_mtime,
+                    "size": st.st_size,
+                    "digest": digest,
+                }
+            cache_paths[path] = cache_dir / f"{digest}.json"
+            if cache_paths[path].exists():
+                print(f"Extracting {path.name} ... (cached)")
+                results[path] = [
+                    TextChunk(**d) for d in _read_json(cache_paths[path])
+                ]
+                continue
+        to_parse.append(path)
+
+    if to_parse:
+        workers = min(len(to_parse), max_workers or os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {
+                pool.submit(_extract_one_file, path, max_chars): path
+                for path in to_parse
+            }
+            for future in as_completed(futures):
+                path = futures[future]
+                file_chunks = future.result()
+                print(f"Extracting {path.name} ... done")
+                cache_path = cache_paths.get(path)
+                if cache_path is not None:
+                    _write_json(cache_path, [asdict(c) for c in file_chunks])
+                results[path] = file_chunks
+
+    if manifest_path is not None:
+        _write_json(manifest_path, manifest)
+
+    # Reassemble in deterministic file order regardless of completion order.
+    # Files with almost no text (title-page-only decks, empty sheets) are
+    # dropped here: sending them costs a full API round trip and yields
+    # nothing an evidence quote could back. Files whose extracted text is
+    # identical to an earlier file — renamed copies, re-exported drafts —
+    # are likewise skipped; their extractions would be exact duplicates.
+    chunks: List[TextChunk] = []
+    seen_content: Dict[str, str] = {}
+    for path in paths:
+        file_chunks = results[path]
+        if sum(len(c.text) for c in file_chunks) < MIN_DOC_CHARS:
+            print(f"Skipping {path.name}: too little text to extract from")
+            continue
+        content_key = hashlib.sha1(
+            "\x00".join(c.text for c in file_chunks).encode("utf-8")
+        ).hexdigest()
+        duplicate_of = seen_content.get(content_key)
+        if duplicate_of is not None:
+            print(f"Skipping {path.name}: identical content to {duplicate_of}")
+            continue
+        seen_content[content_key] = path.name
+        chunks.extend(file_chunks)
+    return chunks
+
+
+# ---------------------------------------------------------------------------
+# Template handling
+# ---------------------------------------------------------------------------
+
+
+def _is_leaf_section(node: Any) -> bool:
+    return isinstance(node, dict) and "update_rule" in node
+
+
+# Leaf collection runs against the same (immutable within a run) template
+# and skeleton objects several times; memoize per object identity.
+_leaf_pointer_cache: Dict[int, List[Tuple[str, dict]]] = {}
+
+
+def _collect_leaf_pointers(node: Any) -> List[Tuple[str, dict]]:
+    """Return ``(json_pointer, leaf_dict)`` pairs for every template leaf."""
+    cached = _leaf_pointer_cache.get(id(node))
+    if cached is not None:
+        return cached
+    leaves: List[Tuple[str, dict]] = []
+    # Iterative depth-first walk; tuples for the path avoid the per-node
+    # list allocations of the recursive `parts + [k]` formulation.
+    stack: List[Tuple[Any, Tuple[str, ...]]] = [(node, ())]
+    while stack:
+        obj, parts = stack.pop()
+        if _is_leaf_section(obj):
+            leaves.append((sys.intern("/" + "/".join(parts)), obj))
+        elif isinstance(obj, dict):
+            for k, v in reversed(obj.items()):
+                stack.append((v, parts + (k,)))
+    _leaf_pointer_cache[id(node)] = leaves
+    return leaves
+
+
+def _collect_leaf_pairs(
+    template: dict, output_doc: dict
+) -> List[Tuple[str, dict, dict]]:
+    """Walk the template and output skeleton in lockstep.
+
+    The skeleton is a structural copy of the template, so one simultaneous
+    walk yields ``(pointer, template_leaf, output_leaf)`` triples without a
+    per-leaf pointer resolution into the other tree.
+    """
+    pairs: List[Tuple[str, dict, dict]] = []
+    stack: List[Tuple[Any, Any, Tuple[str, ...]]] = [(template, output_doc, ())]
+    while stack:
+        t_node, o_node, parts = stack.pop()
+        if _is_leaf_section(t_node):
+            if isinstance(o_node, dict):
+                pairs.append((sys.intern("/" + "/".join(parts)), t_node, o_node))
+        elif isinstance(t_node, dict) and isinstance(o_node, dict):
+            for k, v in reversed(t_node.items()):
+                stack.append((v, o_node.get(k), parts + (k,)))
+    return pairs
+
+
+def _get_by_pointer(doc: Any, pointer: str) -> Optional[Any]:
+    node = doc
+    for part in pointer.strip("/").split("/"):
+        if not isinstance(node, dict) or part not in node:
+            return None
+        node = node[part]
+    return node
+
+
+def prepare_template(
+    template: dict,
+) -> Tuple[dict, List[Dict[str, str]], Dict[str, dict], Dict[str, dict]]:
+    """Derive all per-run template artifacts in a single walk.
+
+    Returns the output skeleton (a copy of the template with seeded
+    ``extracted``/``evidence`` slots), the field catalog sent to the
+    model, and the two pointer-keyed leaf lookup tables used by the merge
+    stage. Producing them together avoids re-walking the template once
+    per artifact.
+    """
+    # The template is pure JSON (no cycles, no custom classes), so a
+    # C-level serialization round-trip copies it far faster than
+    # copy.deepcopy's per-node recursive dispatch.
+    if orjson is not None:
+        output_doc = orjson.loads(orjson.dumps(template))
+    else:
+        output_doc = copy.deepcopy(template)
+    field_catalog: List[Dict[str, str]] = []
+    template_leaves: Dict[str, dict] = {}
+    output_leaves: Dict[str, dict] = {}
+    for pointer, template_leaf, leaf in _collect_leaf_pairs(template, output_doc):
+        rule = leaf.get("update_rule")
+        leaf["extracted"] = [] if rule == "append" else None
+        leaf["evidence"] = []
+        template_leaves[pointer] = template_leaf
+        output_leaves[pointer] = leaf
+        if rule != "locked":
+            field_catalog.append(
+                {
+                    "pointer": pointer,
+                    "update_rule": template_leaf.get("update_rule", ""),
+                    "instruction": template_leaf.get("instruction", ""),
+                }
+            )
+    return output_doc, field_catalog, template_leaves, output_leaves
+
+
+# ---------------------------------------------------------------------------
+# OpenAI extraction
+# ---------------------------------------------------------------------------
+
+
+def _coerce_json_object(raw: str) -> dict:
+    """Parse the model response into a dict, tolerating markdown fences."""
+    s = raw.strip()
+    s = _RE_FENCE_OPEN.sub("", s)
+    s = _RE_FENCE_CLOSE.sub("", s)
+    data = _json_loads(s)
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+    return data
+
+
+def _group_chunks_by_size(
+    chunks: List[TextChunk],
+    max_combined: int = MAX_COMBINED_CHARS,
+    model: Optional[str] = None,
+) -> List[List[TextChunk]]:
+    """Pack consecutive chunks into batches within a combined size budget.
+
+    ``max_combined`` is a character budget. With tiktoken installed and a
+    ``model`` given, chunks are measured in actual tokens against the
+    equivalent token budget instead — character counts under-estimate
+    token-dense text (numbers, multi-byte scripts) and over-truncate
+    plain prose.
+    """
+    encoder = _get_encoder(model) if model else None
+    if encoder is not None:
+        budget = max_combined // APPROX_CHARS_PER_TOKEN
+        measure = lambda text: len(encoder.encode(text))  # noqa: E731
+    else:
+        budget = max_combined
+        measure = len
+
+    batches: List[List[TextChunk]] = []
+    current: List[TextChunk] = []
+    current_size = 0
+    for chunk in chunks:
+        size = measure(chunk.text)
+        if current and current_size + size > budget:
+            batches.append(current)
+            current = []
+            current_size = 0
+        current.append(chunk)
+        current_size += size
+    if current:
+        batches.append(current)
+    return batches
+
+
+_EXTRACT_TASK = (
+    "Extract facts from the sources below for any of the listed fields "
+    "that the sources explicitly support. Follow each field's "
+    "instruction. Include verbatim evidence quotes, each with the "
+    "source_index of the source it was copied from."
+)
+
+
+def _build_user_message(batch: List[TextChunk], fields_json: str) -> str:
+    """Serialize one extraction request's user message.
+
+    Static parts (task, field catalog) come first so every request shares
+    a byte-identical prefix — that is what OpenAI's automatic prompt
+    caching discounts; only the trailing sources vary per call.
+    """
+    sources_json = _json_dumps(
+        [
+            {
+                "source_index": i,
+                "file": chunk.source_file,
+                "location": chunk.location,
+                "text": chunk.text,
+            }
+            for i, chunk in enumerate(batch)
+        ],
+    )
+    return (
+        f'{{"task": {json.dumps(_EXTRACT_TASK)}, '
+        f'"fields": {fields_json}, "sources": {sources_json}}}'
+    )
+
+
+def _request_body(user_message: str, model: str) -> dict:
+    """The Responses API body for one extraction request (shared between
+    the real-time path and Batch API submission)."""
+    return {
+        "model": model,
+        "input": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_message},
+        ],
+        "text": {
+            "format": {
+                "type": "json_schema",
+                "name": "dd_extractions",
+                "schema": EXTRACTIONS_SCHEMA,
+                "strict": True,
+            }
+        },
+    }
+
+
+def _request_cache_path(
+    cache_dir: Optional[Path], user_message: str, model: str
+) -> Optional[Path]:
+    if cache_dir is None:
+        return None
+    request_key = hashlib.sha1(
+        f"{PROMPT_VERSION}\x00{SYSTEM_PROMPT}\x00{user_message}\x00{model}".encode(
+            "utf-8"
+        )
+    ).hexdigest()
+    return cache_dir / f"{request_key}.json"
+
+
+def _parse_extractions(raw_text: str) -> List[dict]:
+    data = _coerce_json_object(raw_text)
+    extractions = data.get("extractions", [])
+    if not isinstance(extractions, list):
+        return []
+    return [e for e in extractions if isinstance(e, dict)]
+
+
+def call_openai_extract(
+    client: OpenAI,
+    batch: List[TextChunk],
+    fields_json: str,
+    model: str,
+    cache_dir: Optional[Path] = None,
+    force_refresh: bool = False,
+) -> List[dict]:
+    """Ask the model for extractions against a batch of source chunks.
+
+    ``fields_json`` is the field catalog serialized once per run; only the
+    per-batch source list is serialized here.
+
+    When ``cache_dir`` is given, responses are cached on disk keyed by a
+    hash of the full request (prompts, sources, model), so re-runs over
+    unchanged inputs skip the network entirely. ``force_refresh`` ignores
+    cached entries but still records fresh ones.
+    """
+    user_message = _build_user_message(batch, fields_json)
+    cache_path = _request_cache_path(cache_dir, user_message, model)
+    if cache_path is not None and not force_refresh and cache_path.exists():
+        return _read_json(cache_path)
+
+    body = _request_body(user_message, model)
+    response = client.responses.create(**body)
+    try:
+        extractions = _parse_extractions(response.output_text)
+    except ValueError as exc:
+        # Strict structured outputs make this near-impossible, but one
+        # corrective round trip is far cheaper than losing the whole
+        # batch: feed the decode error back and ask for valid JSON.
+        retry_body = dict(body)
+        retry_body["input"] = body["input"] + [
+            {"role": "assistant", "content": response.output_text},
+            {
+                "role": "user",
+                "content": (
+                    f"Your previous reply was not valid JSON ({exc}). "
+                    "Return only the corrected JSON object."
+                ),
+            },
+        ]
+        response = client.responses.create(**retry_body)
+        extractions = _parse_extractions(response.output_text)
+    if cache_path is not None:
+        _write_json(cache_path, extractions)
+    return extractions
+
+
+def _batch_output_text(body: dict) -> str:
+    """Pull the concatenated output text out of a raw Responses body."""
+    parts = []
+    for item in body.get("output", []):
+        if item.get("type") != "message":
+            continue
+        for content in item.get("content", []):
+            if content.get("type") == "output_text":
+                parts.append(content.get("text", ""))
+    return "".join(parts)
+
+
+def run_batch_extraction(
+    client: OpenAI,
+    batches: List[List[TextChunk]],
+    fields_json: str,
+    model: str,
+    cache_dir: Optional[Path] = None,
+    force_refresh: bool = False,
+    poll_interval: float = 30.0,
+) -> List[Tuple[List[TextChunk], List[dict]]]:
+    """Run all extractions through the OpenAI Batch API.
+
+    For a non-interactive compile run the Batch API halves token cost and
+    draws on a separate rate-limit pool; the trade-off is completion
+    latency (up to the 24h window, usually much less). Cached batches are
+    served locally and only the misses are submitted.
+    """
+    results: List[Tuple[List[TextChunk], List[dict]]] = []
+    pending: Dict[str, Tuple[List[TextChunk], Optional[Path]]] = {}
+    lines: List[str] = []
+    for i, batch in enumerate(batches):
+        user_message = _build_user_message(batch, fields_json)
+        cache_path = _request_cache_path(cache_dir, user_message, model)
+        if cache_path is not None and not force_refresh and cache_path.exists():
+            results.append((batch, _read_json(cache_path)))
+            continue
+        custom_id = f"extract-{i}"
+        pending[custom_id] = (batch, cache_path)
+        lines.append(
+            _json_dumps(
+                {
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/responses",
+                    "body": _request_body(user_message, model),
+                }
+            )
+        )
+    if not pending:
+        return results
+
+    upload = client.files.create(
+        file=("dd_extractions.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    job = client.batches.create(
+        input_file_id=upload.id,
+        endpoint="/v1/responses",
+        completion_window="24h",
+    )
+    print(f"Submitted batch job {job.id} with {len(pending)} requests")
+    while job.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        job = client.batches.retrieve(job.id)
+    if job.status != "completed" or not job.output_file_id:
+        raise RuntimeError(f"Batch job {job.id} finished with status {job.status}")
+
+    unanswered = dict(pending)
+    for line in client.files.content(job.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        entry = _json_loads(line)
+        batch, cache_path = pending[entry["custom_id"]]
+        unanswered.pop(entry["custom_id"], None)
+        response = entry.get("response") or {}
+        if response.get("status_code") != 200:
+            print(
+                f"  batch request {entry['custom_id']} failed: "
+                f"status {response.get('status_code')}",
+                file=sys.stderr,
+            )
+            continue
+        extractions = _parse_extractions(_batch_output_text(response["body"]))
+        if cache_path is not None:
+            _write_json(cache_path, extractions)
+        results.append((batch, extractions))
+
+    # Requests that fail outright never reach the output file; they land
+    # in the error file instead. Report them — a partially failed batch
+    # run must be as visible as a failed call on the real-time path.
+    if job.error_file_id:
+        for line in client.files.content(job.error_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            entry = _json_loads(line)
+            custom_id = entry.get("custom_id")
+            unanswered.pop(custom_id, None)
+            error = entry.get("error") or entry.get("response") or {}
+            print(
+                f"  batch request {custom_id} failed: {error}",
+                file=sys.stderr,
+            )
+    for custom_id, (batch, _) in unanswered.items():
+        files = ", ".join(sorted({c.source_file for c in batch}))
+        print(
+            f"  batch request {custom_id} ({files}) returned no result",
+            file=sys.stderr,
+        )
+    return results
+
+
+def _extract_one(
+    client: OpenAI,
+    batch: List[TextChunk],
+    fields_json: str,
+    model: str,
+    cache_dir: Optional[Path] = None,
+    force_refresh: bool = False,
+    max_retries: int = 5,
+) -> Tuple[List[TextChunk], List[dict]]:
+    """Worker wrapper: one chunk batch in, ``(batch, extractions)`` out.
+
+    Retries with exponential backoff when the API rate-limits us, so a
+    burst of parallel requests degrades gracefully instead of failing.
+    """
+    from openai import APIConnectionError, APITimeoutError, RateLimitError
+
+    delay = 2.0
+    for attempt in range(max_retries):
+        try:
+            return batch, call_openai_extract(
+                client, batch, fields_json, model, cache_dir, force_refresh
+            )
+        except (RateLimitError, APIConnectionError, APITimeoutError):
+            if attempt == max_retries - 1:
+                raise
+            # Full jitter keeps simultaneous workers from retrying in
+            # lockstep against the same rate limit window.
+            time.sleep(delay + random.uniform(0, delay))
+            delay *= 2
+    return batch, []
+
+
+# ---------------------------------------------------------------------------
+# Validation and merging
+# ---------------------------------------------------------------------------
+
+
+def _locate_quotes(
+    batch: List[TextChunk], extractions: List[dict]
+) -> Dict[str, List[int]]:
+    """Map each evidence quote to the batch indices of chunks containing it.
+
+    With many quotes this uses an Aho-Corasick automaton so every chunk is
+    swept once for all quotes, instead of one substring scan per quote.
+    For a handful of quotes (or without pyahocorasick) the plain ``in``
+    scan is cheaper.
+    """
+    quotes = {
+        ev.get("quote")
+        for extraction in extractions
+        for ev in extraction.get("evidence", [])
+        if isinstance(ev, dict)
+    }
+    quotes.discard(None)
+    quotes.discard("")
+
+    occurrences: Dict[str, List[int]] = {}
+    if ahocorasick is not None and len(quotes) > 3:
+        automaton = ahocorasick.Automaton()
+        for quote in quotes:
+            automaton.add_word(quote, quote)
+        automaton.make_automaton()
+        for i, chunk in enumerate(batch):
+            for _end, quote in automaton.iter(chunk.text):
+                found = occurrences.setdefault(quote, [])
+                if not found or found[-1] != i:
+                    found.append(i)
+    else:
+        for quote in quotes:
+            for i, chunk in enumerate(batch):
+                if quote in chunk.text:
+                    occurrences.setdefault(quote, []).append(i)
+    return occurrences
+
+
+def _dedup_key(value: str) -> str:
+    """Normalize a value for duplicate detection across documents.
+
+    Different sources state the same fact with trivial whitespace and
+    casing differences; comparing collapsed, casefolded text keeps one
+    copy instead of accumulating near-duplicates. The first spelling
+    seen is the one that is stored.
+    """
+    return _RE_ANY_WS.sub(" ", value.strip()).casefold()
+
+
+def validate_and_merge(
+    template_leaves: Dict[str, dict],
+    output_leaves: Dict[str, dict],
+    batch: List[TextChunk],
+    extractions: List[dict],
+    seen_values: Optional[Dict[str, set]] = None,
+) -> int:
+    """Merge extractions into the output leaves, dropping anything unverifiable.
+
+    An extraction is accepted only if its pointer names a known, non-locked
+    template leaf and at least one evidence quote appears verbatim in the
+    source chunk it claims to come from. A quote whose ``source_index`` is
+    missing or wrong is re-attributed to another chunk in the batch that
+    does contain it before it is dropped. Returns the number of accepted
+    extractions.
+
+    ``seen_values`` is a per-pointer set of values already appended to
+    append-rule leaves; pass the same dict across calls so duplicate
+    checks stay O(1) instead of rescanning the accumulated list.
+    """
+    if seen_values is None:
+        seen_values = {}
+    quote_occurrences = _locate_quotes(batch, extractions)
+    accepted = 0
+    for extraction in extractions:
+        pointer = extraction.get("pointer")
+        value = extraction.get("value")
+        if not pointer or value in (None, "", []):
+            continue
+        template_leaf = template_leaves.get(pointer)
+        if template_leaf is None:
+            continue
+        rule = template_leaf.get("update_rule")
+        if rule == "locked":
+            continue
+        output_leaf = output_leaves.get(pointer)
+        if output_leaf is None:
+            continue
+
+        valid_evidence = []
+        for ev in extraction.get("evidence", []):
+            quote = ev.get("quote") if isinstance(ev, dict) else None
+            if not quote:
+                continue
+            found_in = quote_occurrences.get(quote)
+            if not found_in:
+                continue
+            source_index = ev.get("source_index")
+            if source_index not in found_in:
+                source_index = found_in[0]
+            chunk = batch[source_index]
+            valid_evidence.append(Evidence(chunk.source_file, chunk.location, quote))
+        if not valid_evidence:
+            continue
+
+        if rule == "append":
+            seen = seen_values.setdefault(
+                pointer, {_dedup_key(v) for v in output_leaf["extracted"]}
+            )
+            key = _dedup_key(value)
+            if key not in seen:
+                seen.add(key)
+                output_leaf["extracted"].append(value)
+        else:  # overwrite
+            output_leaf["extracted"] = value
+        output_leaf["evidence"].extend(valid_evidence)
+        accepted += 1
+    return accepted
+
+
+def fill_sources_reviewed(output_doc: dict, source_files: List[str]) -> None:
+    """Record the reviewed source file names in the metadata section."""
+    leaf = _get_by_pointer(output_doc, "/document_metadata/sources_reviewed")
+    if not _is_leaf_section(leaf):
+        return
+    existing = leaf["extracted"] if isinstance(leaf["extracted"], list) else []
+    seen = set(existing)
+    leaf["extracted"] = existing + [
+        s for s in source_files if not (s in seen or seen.add(s))
+    ]
+
+
+def add_open_questions_for_missing(template: dict, output_doc: dict) -> None:
+    """List sections that no document answered under open questions."""
+    gaps_leaf = _get_by_pointer(output_doc, "/14_open_questions_and_gaps")
+    if not _is_leaf_section(gaps_leaf):
+        return
+    for pointer, template_leaf, output_leaf in _collect_leaf_pairs(
+        template, output_doc
+    ):
+        if template_leaf.get("update_rule") == "locked":
+            continue
+        if pointer == "/14_open_questions_and_gaps":
+            continue
+        extracted = output_leaf.get("extracted")
+        if extracted is None or extracted == []:
+            gaps_leaf["extracted"].append(
+                f"No information found in the reviewed documents for {pointer}."
+            )
+
+
+# ---------------------------------------------------------------------------
+# Output
+# ---------------------------------------------------------------------------
+
+
+def _json_dumps(data: Any) -> str:
+    """Compact JSON serialization via orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data, ensure_ascii=False)
+
+
+def _json_loads(raw: Any) -> Any:
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _read_json(path: Path) -> Any:
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write_json(path: Path, data: Any) -> None:
+    """Write JSON atomically: concurrent readers (and interrupted runs)
+    never observe a half-written cache entry or output file."""
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    if orjson is not None:
+        tmp_path.write_bytes(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with tmp_path.open("w", encoding="utf-8") as f:
+            # orjson serializes dataclasses natively; mirror that here.
+            json.dump(data, f, ensure_ascii=False, indent=2, default=asdict)
+    os.replace(tmp_path, path)
+
+
+def render_docx(output_doc: dict, path: Path) -> None:
+    """Render the compiled document as DOCX for human review.
+
+    Iterates the precomputed leaf pointers in document order instead of
+    recursively re-walking the tree, emitting parent headings the first
+    time each path prefix appears.
+    """
+    from docx import Document
+
+    doc = Document()
+    doc.add_heading("Due Diligence Master Document", level=0)
+
+    emitted_headings = set()
+    for pointer, leaf in _collect_leaf_pointers(output_doc):
+        parts = pointer.strip("/").split("/")
+        for depth in range(1, len(parts)):
+            prefix = tuple(parts[:depth])
+            if prefix not in emitted_headings:
+                emitted_headings.add(prefix)
+                doc.add_heading(parts[depth - 1].replace("_", " "), level=min(depth, 9))
+        doc.add_heading(parts[-1].replace("_", " "), level=min(len(parts), 9))
+
+        extracted = leaf.get("extracted")
+        if extracted is None or extracted == []:
+            doc.add_paragraph("(no information found)")
+        elif isinstance(extracted, list):
+            for item in extracted:
+                doc.add_paragraph(str(item), style="List Bullet")
+        else:
+            doc.add_paragraph(str(extracted))
+        for ev in leaf.get("evidence", []):
+            doc.add_paragraph(
+                f'Source: {ev.source_file} ({ev.source_location}): "{ev.quote}"',
+                style="Intense Quote",
+            )
+    doc.save(str(path))
+
+
+# ---------------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------------
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--docs-dir", type=Path, default=Path("docs"))
+    parser.add_argument(
+        "--template", type=Path, default=Path("master-document-template.json")
+    )
+    parser.add_argument("--output", type=Path, default=Path("master_document.json"))
+    parser.add_argument("--docx", type=Path, default=Path("master_document.docx"))
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--max-chunk-chars", type=int, default=DEFAULT_MAX_CHUNK_CHARS)
+    parser.add_argument(
+        "--max-batch-chars",
+        type=int,
+        default=MAX_COMBINED_CHARS,
+        help="Combined character budget when packing chunks into one request.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help="Number of parallel OpenAI extraction calls.",
+    )
+    parser.add_argument(
+        "--extract-workers",
+        type=int,
+        default=None,
+        help="Process-pool size for document parsing (default: CPU count).",
+    )
+    parser.add_argument("--cache-dir", type=Path, default=Path(".cache"))
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Disable the on-disk extraction and response caches.",
+    )
+    parser.add_argument(
+        "--force-refresh",
+        action="store_true",
+        help="Ignore cached OpenAI responses (fresh ones are still recorded).",
+    )
+    parser.add_argument(
+        "--use-batch-api",
+        action="store_true",
+        help=(
+            "Submit all extraction requests as one OpenAI Batch API job "
+            "(half the token cost, but completion can take hours)."
+        ),
+    )
+    args = parser.parse_args(argv)
+
+    # Imported here, like the parser libraries, so process-pool workers
+    # re-importing this module never pay for the OpenAI client stack.
+    import httpx
+    from dotenv import load_dotenv
+    from openai import OpenAI
+
+    load_dotenv()
+    # One shared connection pool sized to the thread pool: every worker
+    # reuses a warm keep-alive connection instead of paying TCP + TLS
+    # setup per call, and the pool can never be exhausted mid-run.
+    # The SDK's built-in retry handles short transient blips; the backoff
+    # loop in _extract_one layers on top for sustained rate limiting.
+    client = OpenAI(
+        max_retries=2,
+        http_client=httpx.Client(
+            limits=httpx.Limits(
+                max_connections=args.concurrency,
+                max_keepalive_connections=args.concurrency,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        ),
+    )
+
+    template = _read_json(args.template)
+    output_doc, field_catalog, template_leaves, output_leaves = prepare_template(
+        template
+    )
+    fields_json = _json_dumps(field_catalog)
+
+    text_chunks = extract_text_chunks_from_docs(
+        args.docs_dir,
+        args.max_chunk_chars,
+        cache_dir=None if args.no_cache else args.cache_dir / "extractions",
+        max_workers=args.extract_workers,
+    )
+    if not text_chunks:
+        print(f"No supported documents found in {args.docs_dir}", file=sys.stderr)
+        return 1
+    print(f"Extracted {len(text_chunks)} text chunks from {args.docs_dir}")
+
+    openai_cache_dir = None
+    if not args.no_cache:
+        openai_cache_dir = args.cache_dir / "openai"
+        openai_cache_dir.mkdir(parents=True, exist_ok=True)
+
+    batches = _group_chunks_by_size(text_chunks, args.max_batch_chars, args.model)
+    print(f"Packed {len(text_chunks)} chunks into {len(batches)} extraction requests")
+
+    # Both paths yield (batch, extractions) pairs that are merged on the
+    # main thread, so output_doc is never mutated concurrently.
+    total_accepted = 0
+    seen_values: Dict[str, set] = {}
+    if args.use_batch_api:
+        pairs = run_batch_extraction(
+            client,
+            batches,
+            fields_json,
+            args.model,
+            cache_dir=openai_cache_dir,
+            force_refresh=args.force_refresh,
+        )
+        for batch, extractions in pairs:
+            accepted = validate_and_merge(
+                template_leaves, output_leaves, batch, extractions, seen_values
+            )
+            total_accepted += accepted
+            files = ", ".join(sorted({c.source_file for c in batch}))
+            print(
+                f"  {files} ({len(batch)} chunks): "
+                f"{accepted}/{len(extractions)} extractions accepted"
+            )
+    else:
+        # The extraction calls are network-bound, so run them in a thread
+        # pool and merge as results complete.
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            futures = {
+                pool.submit(
+                    _extract_one,
+                    client,
+                    batch,
+                    fields_json,
+                    args.model,
+                    openai_cache_dir,
+                    args.force_refresh,
+                ): batch
+                for batch in batches
+            }
+            for future in as_completed(futures):
+                # One failed batch should not discard the work of the
+                # others; report it and keep merging what succeeded.
+                try:
+                    batch, extractions = future.result()
+                except Exception as exc:  # noqa: BLE001 - surface any API failure
+                    batch = futures[future]
+                    files = ", ".join(sorted({c.source_file for c in batch}))
+                    print(f"  extraction failed for {files}: {exc}", file=sys.stderr)
+                    continue
+                accepted = validate_and_merge(
+                    template_leaves, output_leaves, batch, extractions, seen_values
+                )
+                total_accepted += accepted
+                files = ", ".join(sorted({c.source_file for c in batch}))
+                print(
+                    f"  {files} ({len(batch)} chunks): "
+                    f"{accepted}/{len(extractions)} extractions accepted"
+                )
+
+    source_files = sorted({c.source_file for c in text_chunks})
+    fill_sources_reviewed(output_doc, source_files)
+    add_open_questions_for_missing(template, output_doc)
+
+    _write_json(args.output, output_doc)
+    print(f"Wrote {args.output} ({total_accepted} accepted extractions)")
+
+    render_docx(output_doc, args.docx)
+    print(f"Wrote {args.docx}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())